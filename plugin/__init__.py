@@ -13,26 +13,33 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
+import array
 import base64
+import collections
+import email.utils
 import hashlib
 import inspect
 import json
+import mimetypes
 import os
 import os.path
 import random
 import re
+import secrets
 import string
 import time
 import unicodedata
+import urllib.parse
 
-from PyQt5.QtCore import QTimer
+from PyQt5.QtCore import QSocketNotifier, QTimer
 from PyQt5.QtWidgets import QMessageBox
 
 import anki
+import anki.hooks
 import anki.lang
 import aqt
 
-from . import web, util
+from . import log, web, util
 
 #
 # AnkiConnect
@@ -40,18 +47,62 @@ from . import web, util
 
 class AnkiConnect:
     def __init__(self):
+        # settings are cached per profile and dropped whenever the add-on config is saved
+        util.invalidateSettings()
+        self.window().addonManager.setConfigUpdatedAction(__name__, util.invalidateSettings)
+
+        if getattr(self, 'log', None) is not None:
+            self.log.close()
+
         self.log = None
         logPath = util.setting('apiLogPath')
         if logPath is not None:
-            self.log = open(logPath, 'w')
+            self.log = log.LogWriter(
+                logPath,
+                util.setting('apiLogMaxBytes'),
+                util.setting('apiLogBackupCount'),
+                util.setting('apiLogQueueSize'),
+                util.setting('apiLogMaxPayload'),
+                util.setting('apiLogSampling')
+            )
+
+        self.actions, self.actionsVersion = self.compileActions()
+        util.pruneDownloadCache()
+        self.batch = False
+        self.queries = {}
+        self.mediaHashes = {}
+        self.manifest = None
+        self.manifestPath = None
+
+        self.cache = collections.OrderedDict()
+        self.cacheState = None
+        self.cacheGeneration = 0
+        self.cacheHits = 0
+        self.cacheMisses = 0
+
+        # edits made outside of the api, such as in the editor or reviewer, also invalidate cached results
+        for hook in (anki.hooks.card_will_flush, anki.hooks.note_will_flush):
+            hook.remove(self.invalidateCache)
+            hook.append(self.invalidateCache)
+
+        if getattr(self, 'notifier', None) is not None:
+            self.notifier.setEnabled(False)
+        self.notifier = None
 
         try:
             self.server = web.WebServer(self.handler)
+            self.server.route('/media/', self.handleMedia, self.openMedia)
             self.server.listen()
 
             self.timer = QTimer()
             self.timer.timeout.connect(self.advance)
-            self.timer.start(util.setting('apiPollInterval'))
+
+            fileno = self.server.fileno()
+            if fileno is None:
+                self.timer.start(util.setting('apiPollInterval'))
+            else:
+                self.notifier = QSocketNotifier(fileno, QSocketNotifier.Read)
+                self.notifier.activated.connect(lambda *args: self.advance())
         except:
             QMessageBox.critical(
                 self.window(),
@@ -59,54 +110,42 @@ class AnkiConnect:
                 'Failed to listen on port {}.\nMake sure it is available and is not in use.'.format(self.server.port)
             )
 
-    def logEvent(self, name, data):
-        if self.log is not None:
-            self.log.write('[{}]\n'.format(name))
-            json.dump(data, self.log, indent=4, sort_keys=True)
-            self.log.write('\n\n')
-            self.log.flush()
-
-
     def advance(self):
         self.server.advance()
 
+        # with readiness notifications the timer is only needed to expire idle connections
+        if self.notifier is not None:
+            if not self.server.clients:
+                self.timer.stop()
+            elif not self.timer.isActive():
+                self.timer.start(1000)
 
-    def handler(self, request):
-        self.logEvent('request', request)
 
+    def handler(self, request):
         name = request.get('action', '')
         version = request.get('version', 4)
         params = request.get('params', {})
         key = request.get('key')
         reply = {'result': None, 'error': None}
 
+        logged = self.log is not None and self.log.sample(name)
+        if logged:
+            self.log.write('request', name, request)
+
         try:
             if key != util.setting('apiKey'):
                 raise Exception('valid api key must be provided')
 
-            method = None
-
-            for methodName, methodInst in inspect.getmembers(self, predicate=inspect.ismethod):
-                apiVersionLast = 0
-                apiNameLast = None
-
-                if getattr(methodInst, 'api', False):
-                    for apiVersion, apiName in getattr(methodInst, 'versions', []):
-                        if apiVersionLast < apiVersion <= version:
-                            apiVersionLast = apiVersion
-                            apiNameLast = apiName
-
-                    if apiNameLast is None and apiVersionLast == 0:
-                        apiNameLast = methodName
-
-                    if apiNameLast is not None and apiNameLast == name:
-                        method = methodInst
-                        break
-
+            method = self.actions.get((min(max(version, 0), self.actionsVersion), name))
             if method is None:
                 raise Exception('unsupported action')
+            elif method.cached:
+                reply['result'] = self.cachedResult(name, method, params)
             else:
-                reply['result'] = methodInst(**params)
+                # anything that may modify the collection drops cached results, as not every change moves col.mod right away
+                if not method.readOnly:
+                    self.invalidateCache()
+                reply['result'] = method(**params)
 
             if version <= 4:
                 reply = reply['result']
@@ -114,10 +153,43 @@ class AnkiConnect:
         except Exception as e:
             reply['error'] = str(e)
 
-        self.logEvent('reply', reply)
+        if logged:
+            self.log.write('reply', name, reply)
+
         return reply
 
 
+    def compileActions(self):
+        methods = []
+        for methodName, methodInst in inspect.getmembers(self, predicate=inspect.ismethod):
+            if getattr(methodInst, 'api', False):
+                methods.append((methodName, methodInst, getattr(methodInst, 'versions', [])))
+
+        # requests for versions past the newest one any action is declared for resolve like the newest one
+        versionMax = util.setting('apiVersion')
+        for methodName, methodInst, versions in methods:
+            for apiVersion, apiName in versions:
+                versionMax = max(versionMax, apiVersion)
+
+        actions = {}
+        for version in range(versionMax + 1):
+            for methodName, methodInst, versions in methods:
+                apiVersionLast = 0
+                apiNameLast = None
+
+                for apiVersion, apiName in versions:
+                    if apiVersionLast < apiVersion <= version:
+                        apiVersionLast = apiVersion
+                        apiNameLast = apiName
+
+                if apiNameLast is None and apiVersionLast == 0:
+                    apiNameLast = methodName
+
+                actions.setdefault((version, apiNameLast), methodInst)
+
+        return actions, versionMax
+
+
     def window(self):
         return aqt.mw
 
@@ -170,25 +242,85 @@ class AnkiConnect:
             return media
 
 
+    def cachedResult(self, name, method, params):
+        # searches relative to the current time or deck change without the collection being modified
+        query = params.get('query')
+        if isinstance(query, str) and re.search(r'(?i)\b(is:(due|learn)|prop:|rated:|added:|edited:|introduced:|resched:|deck:current)', query):
+            return method(**params)
+
+        collection = self.collection()
+        state = (collection.path, collection.mod, collection.scm, self.scheduler().today, self.cacheGeneration)
+        if state != self.cacheState:
+            self.cache.clear()
+            self.cacheState = state
+
+        key = (name, json.dumps(params, sort_keys=True))
+        if key in self.cache:
+            self.cacheHits += 1
+            self.cache.move_to_end(key)
+            result = self.cache[key]
+        else:
+            self.cacheMisses += 1
+            result = method(**params)
+            if inspect.isgenerator(result):
+                result = tuple(result)
+
+            # both the number of results and the number of ids and names they hold in total are bounded
+            itemsMax = util.setting('apiCacheMaxItems')
+            if len(result) <= itemsMax:
+                self.cache[key] = result
+                items = sum(len(value) for value in self.cache.values())
+                while len(self.cache) > util.setting('apiCacheSize') or items > itemsMax:
+                    items -= len(self.cache.popitem(last=False)[1])
+
+        if isinstance(result, tuple):
+            return (value for value in result)
+        else:
+            return result
+
+
+    def invalidateCache(self, *args):
+        self.cacheGeneration += 1
+
+
     def startEditing(self):
-        self.window().requireReset()
+        # requireReset also autosaves, which inside a batch would commit part of it
+        self.invalidateCache()
+        if not self.batch:
+            self.window().requireReset()
 
 
     def stopEditing(self):
-        if self.collection() is not None:
+        # inside a batch the main window is reset once, when the batch ends
+        if self.collection() is not None and not self.batch:
             self.window().maybeReset()
 
 
+    def autosave(self):
+        if not self.batch:
+            self.collection().autosave()
+
+
     def createNote(self, note):
-        collection = self.collection()
+        ankiNote, did = self.buildNote(note)
 
-        model = collection.models.byName(note['modelName'])
-        if model is None:
-            raise Exception('model was not found: {}'.format(note['modelName']))
+        duplicateOrEmpty = ankiNote.dupeOrEmpty()
+        if duplicateOrEmpty == 1:
+            raise Exception('cannot create note because it is empty')
+        elif duplicateOrEmpty == 2:
+          if not self.allowDuplicate(note):
+            raise Exception('cannot create note because it is a duplicate')
+          else:
+            return ankiNote
+        elif duplicateOrEmpty == False:
+            return ankiNote
+        else:
+            raise Exception('cannot create note for unknown reason')
 
-        deck = collection.decks.byName(note['deckName'])
-        if deck is None:
-            raise Exception('deck was not found: {}'.format(note['deckName']))
+
+    def buildNote(self, note, models=None, decks=None):
+        collection = self.collection()
+        model, deck = self.noteModelAndDeck(note, models, decks)
 
         ankiNote = anki.notes.Note(collection, model)
         ankiNote.model()['did'] = deck['id']
@@ -198,6 +330,34 @@ class AnkiConnect:
             if name in ankiNote:
                 ankiNote[name] = value
 
+        self.allowDuplicate(note)
+        return ankiNote, deck['id']
+
+
+    def noteModelAndDeck(self, note, models=None, decks=None):
+        collection = self.collection()
+
+        # bulk callers pass dictionaries so that each model and deck is only looked up once
+        model = models.get(note['modelName']) if models is not None else None
+        if model is None:
+            model = collection.models.byName(note['modelName'])
+            if model is None:
+                raise Exception('model was not found: {}'.format(note['modelName']))
+            if models is not None:
+                models[note['modelName']] = model
+
+        deck = decks.get(note['deckName']) if decks is not None else None
+        if deck is None:
+            deck = collection.decks.byName(note['deckName'])
+            if deck is None:
+                raise Exception('deck was not found: {}'.format(note['deckName']))
+            if decks is not None:
+                decks[note['deckName']] = deck
+
+        return model, deck
+
+
+    def allowDuplicate(self, note):
         allowDuplicate = False
         if 'options' in note:
           if 'allowDuplicate' in note['options']:
@@ -205,25 +365,80 @@ class AnkiConnect:
             if type(allowDuplicate) is not bool:
               raise Exception('option parameter \'allowDuplicate\' must be boolean')
 
-        duplicateOrEmpty = ankiNote.dupeOrEmpty()
-        if duplicateOrEmpty == 1:
-            raise Exception('cannot create note because it is empty')
-        elif duplicateOrEmpty == 2:
-          if not allowDuplicate:
-            raise Exception('cannot create note because it is a duplicate')
-          else:
-            return ankiNote
-        elif duplicateOrEmpty == False:
-            return ankiNote
-        else:
-            raise Exception('cannot create note for unknown reason')
+        return allowDuplicate
+
+
+    def existingFirstFields(self, mid, values):
+        # mirrors Note.dupeOrEmpty for many candidates at once: one checksum query per model
+        stripped = [anki.utils.stripHTMLMedia(value) for value in values]
+        checksums = set(int(anki.utils.checksum(value)[:8], 16) for value in stripped)
+        if not checksums:
+            return set()
+
+        existing = set()
+        for flds in self.database().list('select flds from notes where mid = ? and csum in ' + anki.utils.ids2str(checksums), mid):
+            existing.add(anki.utils.stripHTMLMedia(anki.utils.splitFields(flds)[0]))
+
+        return existing
+
+
+    def downloadAudio(self, note):
+        audio = note.get('audio')
+        if audio is not None and len(audio['fields']) > 0:
+            return util.downloadAsync(audio['url'], audio.get('skipHash'))
+
+
+    def attachAudio(self, ankiNote, note, download=None):
+        audio = note.get('audio')
+        if audio is not None and len(audio['fields']) > 0:
+            try:
+                data = (download or self.downloadAudio(note)).result()
+                skipHash = audio.get('skipHash')
+                if skipHash is None:
+                    skip = False
+                else:
+                    m = hashlib.md5()
+                    m.update(data)
+                    skip = skipHash == m.hexdigest()
+
+                if not skip:
+                    audioFilename = self.media().writeData(audio['filename'], data)
+                    for field in audio['fields']:
+                        if field in ankiNote:
+                            ankiNote[field] += u'[sound:{}]'.format(audioFilename)
+
+            except Exception as e:
+                errorMessage = str(e).replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+                for field in audio['fields']:
+                    if field in ankiNote:
+                        ankiNote[field] += errorMessage
+
+
+    def cardIds(self, cards):
+        # ids are interpolated into SQL, so anything that is not an integer is left out
+        return [card for card in cards if isinstance(card, int)]
+
+
+    def newCards(self, cardIds):
+        return set(self.database().list('select id from cards where type = 0 and id in ' + anki.utils.ids2str(cardIds)))
+
+
+    def latestReviews(self, cardIds):
+        reviews = {}
+        for card, date, ivl in self.database().all(
+            'select r.cid, r.id / 1000.0, r.ivl from revlog r join '
+            '(select max(id) as id from revlog where cid in ' + anki.utils.ids2str(cardIds) + ' group by cid) l on r.id = l.id'
+        ):
+            reviews[card] = (date, ivl)
+
+        return reviews
 
 
     #
     # Miscellaneous
     #
 
-    @util.api()
+    @util.api(readOnly=True)
     def version(self):
         return util.setting('apiVersion')
 
@@ -244,26 +459,120 @@ class AnkiConnect:
         return True
 
 
+    @util.api(readOnly=True)
+    def apiReflect(self, scopes=None, actions=None):
+        if scopes is None:
+            scopes = ['actions']
+
+        result = {'scopes': []}
+
+        if 'actions' in scopes:
+            version = util.setting('apiVersion')
+            names = sorted(name for apiVersion, name in self.actions if apiVersion == version)
+            if actions is not None:
+                names = [name for name in names if name in actions]
+
+            result['scopes'].append('actions')
+            result['actions'] = names
+
+        return result
+
+
+    @util.api(readOnly=True)
+    def cacheStats(self, reset=False):
+        stats = {'hits': self.cacheHits, 'misses': self.cacheMisses, 'entries': len(self.cache)}
+        if reset:
+            self.cache.clear()
+            self.cacheHits = 0
+            self.cacheMisses = 0
+
+        return stats
+
+
     @util.api()
     def sync(self):
         self.window().onSync()
 
 
-    @util.api()
-    def multi(self, actions):
-        return list(map(self.handler, actions))
+    # sub-actions go through the handler and invalidate the cache themselves
+    @util.api(readOnly=True)
+    def multi(self, actions, transactional=False, rollback=False):
+        if self.batch or not (transactional or rollback):
+            return [self.multiReply(action) for action in actions]
+
+        collection = self.collection()
+        if rollback:
+            # commit whatever was pending before the batch so that a rollback only undoes the batch itself
+            collection.save()
+
+        replies = []
+        failed = None
+
+        self.startEditing()
+        try:
+            self.batch = True
+            for index, action in enumerate(actions):
+                try:
+                    reply = self.multiReply(action)
+                except Exception as e:
+                    reply = {'result': None, 'error': str(e)}
+                replies.append(reply)
+                if rollback and isinstance(reply, dict) and reply.get('error') is not None:
+                    failed = index
+                    break
+        finally:
+            self.batch = False
+
+        if failed is None:
+            collection.save()
+        else:
+            collection.rollback()
+            self.invalidateCache()
+            for index in range(len(actions)):
+                if index < failed:
+                    replies[index] = {'result': None, 'error': 'rolled back after action {} failed'.format(failed)}
+                elif index > failed:
+                    replies.append({'result': None, 'error': 'not executed after action {} failed'.format(failed)})
+
+        self.stopEditing()
+        return replies
+
+
+    def multiReply(self, action):
+        reply = self.handler(action)
+        try:
+            if inspect.isgenerator(reply):
+                reply = list(reply)
+            elif isinstance(reply, dict) and inspect.isgenerator(reply.get('result')):
+                reply['result'] = list(reply['result'])
+        except Exception as e:
+            reply = {'result': None, 'error': str(e)}
+
+        return reply
+
+
+    def streamChunks(self, items, chunkSize, load):
+        # the first chunk is loaded before the reply starts, so bad arguments are still reported as ordinary errors
+        first = load(items[:chunkSize])
+        return self.streamRemaining(first, items, chunkSize, load)
+
+
+    def streamRemaining(self, first, items, chunkSize, load):
+        yield from first
+        for offset in range(chunkSize, len(items), chunkSize):
+            yield from load(items[offset : offset + chunkSize])
 
 
     #
     # Decks
     #
 
-    @util.api()
+    @util.api(cached=True)
     def deckNames(self):
         return self.decks().allNames()
 
 
-    @util.api()
+    @util.api(readOnly=True)
     def deckNamesAndIds(self):
         decks = {}
         for deck in self.deckNames():
@@ -272,12 +581,18 @@ class AnkiConnect:
         return decks
 
 
-    @util.api()
+    @util.api(readOnly=True)
     def getDecks(self, cards):
+        dids = dict(self.database().all('select id, did from cards where id in ' + anki.utils.ids2str(self.cardIds(cards))))
+
+        deckNames = {}
         decks = {}
         for card in cards:
-            did = self.database().scalar('select did from cards where id=?', card)
-            deck = self.decks().get(did)['name']
+            did = dids.get(card)
+            if did not in deckNames:
+                deckNames[did] = self.decks().get(did)['name']
+
+            deck = deckNames[did]
             if deck in decks:
                 decks[deck].append(card)
             else:
@@ -327,7 +642,7 @@ class AnkiConnect:
             self.stopEditing()
 
 
-    @util.api()
+    @util.api(readOnly=True)
     def getDeckConfig(self, deck):
         if not deck in self.deckNames():
             return False
@@ -394,16 +709,32 @@ class AnkiConnect:
 
     @util.api()
     def storeMediaFile(self, filename, data):
-        self.deleteMediaFile(filename)
-        self.media().writeData(filename, base64.b64decode(data))
+        self.storeMedia(filename, base64.b64decode(data))
 
 
     @util.api()
-    def retrieveMediaFile(self, filename):
-        filename = os.path.basename(filename)
-        filename = unicodedata.normalize('NFC', filename)
-        filename = self.media().stripIllegal(filename)
+    def storeMediaFiles(self, files):
+        results = []
+        for file in files:
+            filename = self.mediaFilename(file['filename'])
+            path = os.path.join(self.media().dir(), filename)
+
+            # a matching hash means the client does not need to send the file at all
+            if file.get('hash') is not None and os.path.isfile(path) and self.mediaHash(path, os.stat(path)) == file['hash'].lower():
+                status = 'unchanged'
+            elif file.get('data') is None:
+                status = 'missing'
+            else:
+                status = self.storeMedia(filename, base64.b64decode(file['data']))
+
+            results.append({'filename': filename, 'status': status})
+
+        return results
+
 
+    @util.api(readOnly=True)
+    def retrieveMediaFile(self, filename):
+        filename = self.mediaFilename(filename)
         path = os.path.join(self.media().dir(), filename)
         if os.path.exists(path):
             with open(path, 'rb') as file:
@@ -412,51 +743,277 @@ class AnkiConnect:
         return False
 
 
+    @util.api(readOnly=True)
+    def retrieveMediaFiles(self, files):
+        directory = self.media().dir()
+        requested = [(self.mediaFilename(file['filename']), (file.get('hash') or '').lower()) for file in files]
+        return self.streamChunks(requested, 1, lambda chunk: [self.retrieveMedia(directory, *item) for item in chunk])
+
+
+    def retrieveMedia(self, directory, filename, digest):
+        path = os.path.join(directory, filename)
+        if not os.path.isfile(path):
+            return {'filename': filename, 'status': 'missing'}
+
+        current = self.mediaHash(path, os.stat(path))
+        if current == digest:
+            return {'filename': filename, 'status': 'unchanged', 'hash': current}
+
+        with open(path, 'rb') as data:
+            return {'filename': filename, 'status': 'retrieved', 'hash': current, 'data': base64.b64encode(data.read()).decode('ascii')}
+
+
+    @util.api(readOnly=True)
+    def mediaManifest(self, since=None):
+        manifest = self.refreshManifest()
+
+        # tokens from another manifest, such as one that was lost or belongs to another profile, start over from scratch
+        ident, _, seq = (since or '').partition('-')
+        full = ident != manifest['id'] or not seq.isdigit()
+        since = 0 if full else int(seq)
+
+        files = []
+        for filename, (size, mtime, digest, seq) in sorted(manifest['files'].items()):
+            if seq > since:
+                files.append({'filename': filename, 'size': size, 'mtime': mtime // 1000000000, 'hash': digest})
+
+        deleted = [] if full else sorted(filename for filename, seq in manifest['deleted'].items() if seq > since)
+
+        return {'token': '{}-{}'.format(manifest['id'], manifest['seq']), 'full': full, 'files': files, 'deleted': deleted}
+
+
     @util.api()
     def deleteMediaFile(self, filename):
         self.media().syncDelete(filename)
 
 
-    @util.api()
-    def addNote(self, note):
-        ankiNote = self.createNote(note)
+    def mediaFilename(self, filename):
+        filename = os.path.basename(filename)
+        filename = unicodedata.normalize('NFC', filename)
+        return self.media().stripIllegal(filename)
 
-        audio = note.get('audio')
-        if audio is not None and len(audio['fields']) > 0:
+
+    def storeMedia(self, filename, data):
+        # rewriting an identical file would only mark it as changed for the next sync
+        path = os.path.join(self.media().dir(), self.mediaFilename(filename))
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            if stat.st_size == len(data) and self.mediaHash(path, stat) == hashlib.sha1(data).hexdigest():
+                return 'unchanged'
+
+        self.deleteMediaFile(filename)
+        self.media().writeData(filename, data)
+        return 'stored'
+
+
+    def mediaTarget(self, req):
+        target = urllib.parse.urlsplit(req.path.decode('latin-1'))
+        filename = urllib.parse.unquote(target.path[len('/media/'):])
+        key = urllib.parse.parse_qs(target.query).get('key', [None])[0]
+        return filename, key
+
+
+    def openMedia(self, req):
+        if req.method != 'PUT'.encode('utf-8'):
+            return None
+
+        # uploads are spooled next to the media folder, and bodies that will be rejected are dropped as they arrive
+        try:
+            if self.mediaTarget(req)[1] == util.setting('apiKey'):
+                return web.WebUpload(os.path.dirname(self.media().dir()))
+        except Exception:
+            pass
+
+        return open(os.devnull, 'wb')
+
+
+    def handleMedia(self, req):
+        try:
+            filename, key = self.mediaTarget(req)
+            if key != util.setting('apiKey'):
+                return self.mediaReply('403 Forbidden', None, 'valid api key must be provided')
+
+            filename = self.mediaFilename(filename)
+            if not filename:
+                return self.mediaReply('400 Bad Request', None, 'filename was not provided')
+
+            path = os.path.join(self.media().dir(), filename)
+            if req.method == 'PUT'.encode('utf-8'):
+                req.body.commit(path)
+                return self.mediaReply('200 OK', filename)
+            elif req.method == 'GET'.encode('utf-8'):
+                if not os.path.isfile(path):
+                    return self.mediaReply('404 Not Found', None, 'file was not found: {}'.format(filename))
+
+                file = open(path, 'rb')
+                stat = os.fstat(file.fileno())
+                etag = '"{}"'.format(self.mediaHash(path, stat))
+                headers = [
+                    ['Content-Type', mimetypes.guess_type(filename)[0] or 'application/octet-stream'],
+                    ['Accept-Ranges', 'bytes'],
+                    ['ETag', etag],
+                    ['Last-Modified', email.utils.formatdate(stat.st_mtime, usegmt=True)]
+                ]
+
+                if self.mediaNotModified(req, etag, stat):
+                    file.close()
+                    return '304 Not Modified', headers, bytes()
+
+                span = self.mediaRange(req, etag, stat.st_size)
+                if span is None:
+                    return '200 OK', headers, web.WebFile(file, 0, stat.st_size)
+                elif span is False:
+                    file.close()
+                    headers.append(['Content-Range', 'bytes */{}'.format(stat.st_size)])
+                    return '416 Range Not Satisfiable', headers, bytes()
+                else:
+                    headers.append(['Content-Range', 'bytes {}-{}/{}'.format(span[0], span[1], stat.st_size)])
+                    return '206 Partial Content', headers, web.WebFile(file, span[0], span[1] - span[0] + 1)
+            else:
+                return self.mediaReply('405 Method Not Allowed', None, 'unsupported method')
+        except Exception as e:
+            return self.mediaReply('500 Internal Server Error', None, str(e))
+        finally:
+            if hasattr(req.body, 'close'):
+                req.body.close()
+
+
+    def mediaReply(self, status, result, error=None):
+        body = json.dumps({'result': result, 'error': error}).encode('utf-8')
+        return status, [['Content-Type', 'text/json']], body
+
+
+    def mediaHash(self, path, stat):
+        # hashes are only recomputed when a file's size or modification time changes
+        cached = self.mediaHashes.get(path)
+        if cached is not None and cached[:2] == (stat.st_size, stat.st_mtime_ns):
+            return cached[2]
+
+        digest = hashlib.sha1()
+        with open(path, 'rb') as file:
+            for chunk in iter(lambda: file.read(1 << 20), bytes()):
+                digest.update(chunk)
+
+        self.mediaHashes[path] = (stat.st_size, stat.st_mtime_ns, digest.hexdigest())
+        return digest.hexdigest()
+
+
+    def refreshManifest(self):
+        directory = self.media().dir()
+        path = os.path.join(os.path.dirname(directory), 'ankiconnect_media.json')
+
+        if self.manifestPath != path:
             try:
-                data = util.download(audio['url'])
-                skipHash = audio.get('skipHash')
-                if skipHash is None:
-                    skip = False
+                with open(path, encoding='utf-8') as file:
+                    self.manifest = json.load(file)
+            except (OSError, ValueError):
+                self.manifest = {'id': secrets.token_hex(8), 'seq': 0, 'files': {}, 'deleted': {}}
+
+            self.manifestPath = path
+            for filename, (size, mtime, digest, seq) in self.manifest['files'].items():
+                self.mediaHashes.setdefault(os.path.join(directory, filename), (size, mtime, digest))
+
+        # every entry is compared by size and modification time, which also catches files rewritten in place;
+        # only files that differ are hashed again
+        manifest = self.manifest
+        seq = manifest['seq'] + 1
+        changed = False
+        dirty = False
+        seen = set()
+
+        with os.scandir(directory) as it:
+            for entry in it:
+                if entry.name.startswith('.') or not entry.is_file():
+                    continue
+
+                seen.add(entry.name)
+                stat = entry.stat()
+                current = manifest['files'].get(entry.name)
+                if current is not None and current[:2] == [stat.st_size, stat.st_mtime_ns]:
+                    continue
+
+                digest = self.mediaHash(entry.path, stat)
+                dirty = True
+                if current is not None and current[2] == digest:
+                    current[:2] = [stat.st_size, stat.st_mtime_ns]
                 else:
-                    m = hashlib.md5()
-                    m.update(data)
-                    skip = skipHash == m.hexdigest()
+                    manifest['files'][entry.name] = [stat.st_size, stat.st_mtime_ns, digest, seq]
+                    manifest['deleted'].pop(entry.name, None)
+                    changed = True
 
-                if not skip:
-                    audioFilename = self.media().writeData(audio['filename'], data)
-                    for field in audio['fields']:
-                        if field in ankiNote:
-                            ankiNote[field] += u'[sound:{}]'.format(audioFilename)
+        for filename in [filename for filename in manifest['files'] if filename not in seen]:
+            del manifest['files'][filename]
+            manifest['deleted'][filename] = seq
+            changed = True
 
-            except Exception as e:
-                errorMessage = str(e).replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
-                for field in audio['fields']:
-                    if field in ankiNote:
-                        ankiNote[field] += errorMessage
+        if changed:
+            manifest['seq'] = seq
+
+        if dirty or changed:
+            with open(path + '.tmp', 'w', encoding='utf-8') as file:
+                json.dump(manifest, file)
+            os.replace(path + '.tmp', path)
+
+        return manifest
+
+
+    def mediaNotModified(self, req, etag, stat):
+        ifNoneMatch = req.headers.get('if-none-match'.encode('utf-8'))
+        if ifNoneMatch is not None:
+            tags = [tag.strip() for tag in ifNoneMatch.decode('latin-1').split(',')]
+            return '*' in tags or etag in tags or 'W/' + etag in tags
+
+        ifModifiedSince = req.headers.get('if-modified-since'.encode('utf-8'))
+        if ifModifiedSince is not None:
+            try:
+                return int(stat.st_mtime) <= email.utils.parsedate_to_datetime(ifModifiedSince.decode('latin-1')).timestamp()
+            except (TypeError, ValueError):
+                pass
+
+        return False
+
+
+    def mediaRange(self, req, etag, size):
+        # only single byte ranges are honored; anything else is answered with the whole file
+        value = (req.headers.get('range'.encode('utf-8')) or bytes()).decode('latin-1').strip()
+        ifRange = req.headers.get('if-range'.encode('utf-8'))
+        if not value.startswith('bytes=') or ',' in value or (ifRange is not None and ifRange.decode('latin-1') != etag):
+            return None
+
+        first, _, last = value[len('bytes='):].partition('-')
+        try:
+            if first:
+                start, end = int(first), int(last) if last else max(int(first), size - 1)
+                if end < start:
+                    return None
+            else:
+                start, end = max(size - int(last), 0), size - 1
+        except ValueError:
+            return None
+
+        if start >= size or end < start:
+            return False
+        else:
+            return start, min(end, size - 1)
+
+
+    @util.api()
+    def addNote(self, note):
+        ankiNote = self.createNote(note)
+        self.attachAudio(ankiNote, note)
 
         collection = self.collection()
         self.startEditing()
         nCardsAdded = collection.addNote(ankiNote)
         if nCardsAdded < 1:
             raise Exception('The field values you have provided would make an empty question on all cards.')
-        collection.autosave()
+        self.autosave()
         self.stopEditing()
 
         return ankiNote.id
 
 
-    @util.api()
+    @util.api(readOnly=True)
     def canAddNote(self, note):
         try:
             return bool(self.createNote(note))
@@ -477,6 +1034,83 @@ class AnkiConnect:
         ankiNote.flush()
 
 
+    @util.api()
+    def updateNotesFields(self, notes):
+        chunkSize = 1000
+        collection = self.collection()
+        models = {}
+        pending = {}
+        results = []
+
+        for offset in range(0, len(notes), chunkSize):
+            chunk = notes[offset : offset + chunkSize]
+            rows = {}
+            for nid, mid, flds in self.database().all(
+                'select id, mid, flds from notes where id in ' + anki.utils.ids2str(note.get('id') for note in chunk if isinstance(note.get('id'), int))
+            ):
+                rows[nid] = (mid, anki.utils.splitFields(flds))
+
+            for note in chunk:
+                nid = note.get('id')
+                if nid not in rows:
+                    results.append({'result': None, 'error': 'note was not found: {}'.format(nid)})
+                    continue
+
+                mid, fields = rows[nid]
+                if mid not in models:
+                    model = collection.models.get(mid)
+                    models[mid] = ({field['name']: field['ord'] for field in model['flds']}, model['sortf'])
+
+                # a note listed more than once builds on its earlier, not yet written, update
+                names = models[mid][0]
+                current = pending.get(nid, (mid, fields))[1]
+                updated = list(current)
+                for name, value in note.get('fields', {}).items():
+                    if name in names:
+                        updated[names[name]] = value
+
+                if updated == current:
+                    results.append({'result': 'unchanged', 'error': None})
+                else:
+                    pending[nid] = (mid, updated)
+                    results.append({'result': 'updated', 'error': None})
+
+        if pending:
+            mod = anki.utils.intTime()
+            usn = collection.usn()
+            updates = []
+            for nid, (mid, fields) in pending.items():
+                updates.append((
+                    anki.utils.joinFields(fields),
+                    anki.utils.stripHTMLMedia(fields[models[mid][1]]),
+                    anki.utils.fieldChecksum(fields[0]),
+                    mod,
+                    usn,
+                    nid
+                ))
+
+            # every changed note is written with one statement and committed together
+            self.startEditing()
+            try:
+                self.database().executemany('update notes set flds=?, sfld=?, csum=?, mod=?, usn=? where id=?', updates)
+                if hasattr(collection, 'after_note_updates'):
+                    collection.after_note_updates(list(pending), mark_modified=False)
+                else:
+                    collection.genCards(list(pending))
+                if not self.batch:
+                    collection.save()
+            except:
+                # within multi the whole batch is rolled back by the caller
+                if not self.batch:
+                    collection.rollback()
+                    self.invalidateCache()
+                raise
+            finally:
+                self.stopEditing()
+
+        return results
+
+
     @util.api()
     def addTags(self, notes, tags, add=True):
         self.startEditing()
@@ -489,16 +1123,14 @@ class AnkiConnect:
         return self.addTags(notes, tags, False)
 
 
-    @util.api()
+    @util.api(cached=True)
     def getTags(self):
         return self.collection().tags.all()
 
 
     @util.api()
     def suspend(self, cards, suspend=True):
-        for card in cards:
-            if self.suspended(card) == suspend:
-                cards.remove(card)
+        cards = [card for card, suspended in zip(cards, self.areSuspended(cards)) if suspended != suspend]
 
         if len(cards) == 0:
             return False
@@ -519,54 +1151,78 @@ class AnkiConnect:
         self.suspend(cards, False)
 
 
-    @util.api()
+    @util.api(readOnly=True)
     def suspended(self, card):
         card = self.collection().getCard(card)
         return card.queue == -1
 
 
-    @util.api()
+    @util.api(readOnly=True)
     def areSuspended(self, cards):
+        queues = dict(self.database().all('select id, queue from cards where id in ' + anki.utils.ids2str(self.cardIds(cards))))
+
         suspended = []
         for card in cards:
-            suspended.append(self.suspended(card))
+            if card not in queues:
+                raise Exception('card was not found: {}'.format(card))
+            suspended.append(queues[card] == -1)
 
         return suspended
 
 
-    @util.api()
+    @util.api(readOnly=True)
     def areDue(self, cards):
+        cardIds = self.cardIds(cards)
+        newCards = self.newCards(cardIds)
+        reviews = self.latestReviews(cardIds)
+
+        # learning steps measured in seconds are checked against the clock, everything else is left to the scheduler's search
+        candidates = [card for card in cardIds if card not in newCards and reviews.get(card, (0, 0))[1] >= -1200]
+        dueCards = set()
+        if candidates:
+            dueCards.update(self.collection().findCards('cid:{} is:due'.format(','.join(str(card) for card in candidates))))
+
         due = []
         for card in cards:
-            if self.findCards('cid:{} is:new'.format(card)):
+            if card in newCards:
                 due.append(True)
+            elif card in dueCards:
+                due.append(True)
+            elif card in reviews and reviews[card][1] < -1200:
+                date, ivl = reviews[card]
+                due.append(date - ivl <= time.time())
             else:
-                date, ivl = self.collection().db.all('select id/1000.0, ivl from revlog where cid = ?', card)[-1]
-                if ivl >= -1200:
-                    due.append(bool(self.findCards('cid:{} is:due'.format(card))))
-                else:
-                    due.append(date - ivl <= time.time())
+                due.append(False)
 
         return due
 
 
-    @util.api()
+    @util.api(readOnly=True)
     def getIntervals(self, cards, complete=False):
+        cardIds = self.cardIds(cards)
+        newCards = self.newCards(cardIds)
+
+        if complete:
+            history = {}
+            for card, ivl in self.database().all('select cid, ivl from revlog where cid in ' + anki.utils.ids2str(cardIds) + ' order by id'):
+                history.setdefault(card, []).append(ivl)
+        else:
+            history = {card: ivl for card, (date, ivl) in self.latestReviews(cardIds).items()}
+            # cards without any review history fall back to the interval stored on the card
+            for card, ivl in self.database().all('select id, ivl from cards where id in ' + anki.utils.ids2str(cardIds)):
+                history.setdefault(card, ivl)
+
         intervals = []
         for card in cards:
-            if self.findCards('cid:{} is:new'.format(card)):
+            if card in newCards:
                 intervals.append(0)
             else:
-                interval = self.collection().db.list('select ivl from revlog where cid = ?', card)
-                if not complete:
-                    interval = interval[-1]
-                intervals.append(interval)
+                intervals.append(history.get(card, [] if complete else 0))
 
         return intervals
 
 
-
-    @util.api()
+    @util.api(cached=True)
     def modelNames(self):
         return self.collection().models.allNames()
 
@@ -609,7 +1265,7 @@ class AnkiConnect:
         return m
 
 
-    @util.api()
+    @util.api(readOnly=True)
     def modelNamesAndIds(self):
         models = {}
         for model in self.modelNames():
@@ -618,7 +1274,7 @@ class AnkiConnect:
         return models
 
 
-    @util.api()
+    @util.api(readOnly=True)
     def modelNameFromId(self, modelId):
         model = self.collection().models.get(modelId)
         if model is None:
@@ -627,7 +1283,7 @@ class AnkiConnect:
             return model['name']
 
 
-    @util.api()
+    @util.api(cached=True)
     def modelFieldNames(self, modelName):
         model = self.collection().models.byName(modelName)
         if model is None:
@@ -636,7 +1292,7 @@ class AnkiConnect:
             return [field['name'] for field in model['flds']]
 
 
-    @util.api()
+    @util.api(readOnly=True)
     def modelFieldsOnTemplates(self, modelName):
         model = self.collection().models.byName(modelName)
         if model is None:
@@ -666,7 +1322,7 @@ class AnkiConnect:
 
         return templates
 
-    @util.api()
+    @util.api(readOnly=True)
     def modelTemplates(self, modelName):
         model = self.collection().models.byName(modelName)
         if model is None:
@@ -679,7 +1335,7 @@ class AnkiConnect:
         return templates
 
 
-    @util.api()
+    @util.api(readOnly=True)
     def modelStyling(self, modelName):
         model = self.collection().models.byName(modelName)
         if model is None:
@@ -725,7 +1381,7 @@ class AnkiConnect:
         models.flush()
 
 
-    @util.api()
+    @util.api(readOnly=True)
     def deckNameFromId(self, deckId):
         deck = self.collection().decks.get(deckId)
         if deck is None:
@@ -734,65 +1390,161 @@ class AnkiConnect:
             return deck['name']
 
 
-    @util.api()
+    @util.api(cached=True)
     def findNotes(self, query=None):
         if query is None:
             return []
         else:
-            return self.collection().findNotes(query)
+            return (nid for nid in self.collection().findNotes(query))
 
 
-    @util.api()
+    @util.api(cached=True)
     def findCards(self, query=None):
         if query is None:
             return []
         else:
-            return self.collection().findCards(query)
+            return (cid for cid in self.collection().findCards(query))
 
 
-    @util.api()
+    @util.api(readOnly=True)
+    def openQuery(self, query, type='cards'):
+        if type == 'cards':
+            ids = self.collection().findCards(query)
+        elif type == 'notes':
+            ids = self.collection().findNotes(query)
+        else:
+            raise Exception('unsupported query type: {}'.format(type))
+
+        self.expireQueries()
+
+        # the oldest cursor is dropped to make room once the limit is reached
+        while self.queries and len(self.queries) >= util.setting('apiQueryLimit'):
+            self.queries.pop(min(self.queries, key=lambda cursor: self.queries[cursor]['expires']))
+
+        cursor = secrets.token_urlsafe(16)
+        self.queries[cursor] = {
+            'ids': array.array('q', ids),
+            'offset': 0,
+            'expires': time.monotonic() + util.setting('apiQueryTTL') / 1000
+        }
+
+        return {'cursor': cursor, 'total': len(ids)}
+
+
+    @util.api(readOnly=True)
+    def fetchQuery(self, cursor, limit=1000):
+        self.expireQueries()
+
+        query = self.queries.get(cursor)
+        if query is None:
+            raise Exception('query cursor was not found or has expired: {}'.format(cursor))
+
+        offset = query['offset']
+        ids = query['ids'][offset : offset + max(limit, 0)].tolist()
+        query['offset'] = offset + len(ids)
+        query['expires'] = time.monotonic() + util.setting('apiQueryTTL') / 1000
+
+        remaining = len(query['ids']) - query['offset']
+        if remaining == 0:
+            del self.queries[cursor]
+
+        return {'ids': ids, 'remaining': remaining}
+
+
+    @util.api(readOnly=True)
+    def closeQuery(self, cursor):
+        return self.queries.pop(cursor, None) is not None
+
+
+    def expireQueries(self):
+        now = time.monotonic()
+        for cursor in [cursor for cursor, query in self.queries.items() if query['expires'] <= now]:
+            del self.queries[cursor]
+
+
+    @util.api(readOnly=True)
     def cardsInfo(self, cards):
-        result = []
-        for cid in cards:
-            try:
-                card = self.collection().getCard(cid)
-                model = card.model()
-                note = card.note()
-                fields = {}
-                for info in model['flds']:
-                    order = info['ord']
-                    name = info['name']
-                    fields[name] = {'value': note.fields[order], 'order': order}
-
-                ansButtonLen = self.window().col.sched.answerButtons(card)
-                result.append({
-                    'cardId': card.id,
-                    'fields': fields,
-                    'fieldOrder': card.ord,
-                    #  'question': card._getQA()['q'],
-                    #  'answer': card._getQA()['a'],
-                    'modelName': model['name'],
-                    'answerButtons': ansButtonLen,
-                    'nextReviews': [self.window().col.sched.nextIvlStr(card, b, True) for b in range(1, ansButtonLen+1)],
-                    'template':card.template(),
-                    'deckName': self.deckNameFromId(card.did),
-                    'css': model['css'],
-                    'factor': card.factor,
-                    #This factor is 10 times the ease percentage,
-                    # so an ease of 310% would be reported as 3100
-                    'interval': card.ivl,
-                    'note': card.nid,
-                    'due':card.due,
-                    'dueDate': util.nextDue(card)
-                })
-            except TypeError as e:
-                # Anki will give a TypeError if the card ID does not exist.
+        collection = self.collection()
+        scheduler = self.scheduler()
+        models = {}
+        deckNames = {}
+
+        # cards and their notes are loaded with one joined query per chunk, which keeps memory bounded while streaming
+        return self.streamChunks(cards, 1000, lambda chunk: self.cardsInfoChunk(chunk, collection, scheduler, models, deckNames))
+
+
+    def cardsInfoChunk(self, chunk, collection, scheduler, models, deckNames):
+        rows = {}
+        for row in self.database().all(
+            'select c.id, c.nid, c.did, c.ord, c.mod, c.usn, c.type, c.queue, c.due, c.ivl, c.factor, c.reps, c.lapses, '
+            'c.left, c.odue, c.odid, c.flags, c.data, n.mid, n.flds from cards c join notes n on n.id = c.nid '
+            'where c.id in ' + anki.utils.ids2str(cid for cid in chunk if isinstance(cid, int))
+        ):
+            rows[row[0]] = row
+
+        results = []
+        for cid in chunk:
+            row = rows.get(cid)
+            if row is None:
                 # Best behavior is probably to add an 'empty card' to the
                 # returned result, so that the items of the input and return
                 # lists correspond.
-                result.append({})
+                results.append({})
+                continue
+
+            # the card is filled from the row directly; Card() itself would set up defaults, on older versions with a query of its own
+            card = anki.cards.Card.__new__(anki.cards.Card)
+            card.col = collection
+            card.timerStarted = None
+            card._render_output = None
+            card._note = None
+            (card.id, card.nid, card.did, card.ord, card.mod, card.usn, card.type, card.queue, card.due, card.ivl,
+                card.factor, card.reps, card.lapses, card.left, card.odue, card.odid, card.flags, card.data) = row[:18]
+
+            mid, flds = row[18:]
+            model = models.get(mid)
+            if model is None:
+                model = models[mid] = collection.models.get(mid)
+
+            if card.did not in deckNames:
+                deckNames[card.did] = self.deckNameFromId(card.did)
+
+            values = anki.utils.splitFields(flds)
+            fields = {}
+            for info in model['flds']:
+                order = info['ord']
+                name = info['name']
+                fields[name] = {'value': values[order], 'order': order}
+
+            if model['type'] == anki.consts.MODEL_STD:
+                template = model['tmpls'][card.ord]
+            else:
+                template = model['tmpls'][0]
+
+            ansButtonLen = scheduler.answerButtons(card)
+            results.append({
+                'cardId': card.id,
+                'fields': fields,
+                'fieldOrder': card.ord,
+                #  'question': card._getQA()['q'],
+                #  'answer': card._getQA()['a'],
+                'modelName': model['name'],
+                'answerButtons': ansButtonLen,
+                'nextReviews': [scheduler.nextIvlStr(card, b, True) for b in range(1, ansButtonLen+1)],
+                'template': template,
+                'deckName': deckNames[card.did],
+                'css': model['css'],
+                'factor': card.factor,
+                #This factor is 10 times the ease percentage,
+                # so an ease of 310% would be reported as 3100
+                'interval': card.ivl,
+                'note': card.nid,
+                'due':card.due,
+                'dueDate': util.nextDue(card)
+            })
+
+        return results
 
-        return result
 
     @util.api()
     def answerCard(self, cid, ease=2):
@@ -800,35 +1552,57 @@ class AnkiConnect:
         card.startTimer()
         self.window().col.sched.answerCard(card, ease)
 
-    @util.api()
+    @util.api(readOnly=True)
     def notesInfo(self, notes):
-        result = []
-        for nid in notes:
-            try:
-                note = self.collection().getNote(nid)
-                model = note.model()
-
-                fields = {}
-                for info in model['flds']:
-                    order = info['ord']
-                    name = info['name']
-                    fields[name] = {'value': note.fields[order], 'order': order}
-
-                result.append({
-                    'noteId': note.id,
-                    'tags' : note.tags,
-                    'fields': fields,
-                    'modelName': model['name'],
-                    'cards': self.collection().db.list('select id from cards where nid = ? order by ord', note.id)
-                })
-            except TypeError as e:
-                # Anki will give a TypeError if the note ID does not exist.
+        collection = self.collection()
+        models = {}
+
+        # each chunk costs one query for the notes and one for all of their cards
+        return self.streamChunks(notes, 1000, lambda chunk: self.notesInfoChunk(chunk, collection, models))
+
+
+    def notesInfoChunk(self, chunk, collection, models):
+        nids = anki.utils.ids2str(nid for nid in chunk if isinstance(nid, int))
+
+        rows = {}
+        for row in self.database().all('select id, mid, tags, flds from notes where id in ' + nids):
+            rows[row[0]] = row
+
+        cards = {}
+        for nid, cid in self.database().all('select nid, id from cards where nid in ' + nids + ' order by nid, ord'):
+            cards.setdefault(nid, []).append(cid)
+
+        results = []
+        for nid in chunk:
+            row = rows.get(nid)
+            if row is None:
                 # Best behavior is probably to add an 'empty card' to the
                 # returned result, so that the items of the input and return
                 # lists correspond.
-                result.append({})
+                results.append({})
+                continue
 
-        return result
+            nid, mid, tags, flds = row
+            if mid not in models:
+                model = collection.models.get(mid)
+                models[mid] = (model['name'], [(info['name'], info['ord']) for info in model['flds']])
+
+            modelName, modelFields = models[mid]
+            values = anki.utils.splitFields(flds)
+
+            fields = {}
+            for name, order in modelFields:
+                fields[name] = {'value': values[order], 'order': order}
+
+            results.append({
+                'noteId': nid,
+                'tags' : collection.tags.split(tags),
+                'fields': fields,
+                'modelName': modelName,
+                'cards': cards.get(nid, [])
+            })
+
+        return results
 
 
     @util.api()
@@ -841,7 +1615,7 @@ class AnkiConnect:
 
 
 
-    @util.api()
+    @util.api(readOnly=True)
     def cardsToNotes(self, cards):
         return self.collection().db.list('select distinct nid from cards where id in ' + anki.utils.ids2str(cards))
 
@@ -998,12 +1772,12 @@ class AnkiConnect:
             addCards = aqt.dialogs.open('AddCards', self.window())
             addCards.activateWindow()
 
-    @util.api()
+    @util.api(readOnly=True)
     def guiReviewActive(self):
         return self.reviewer().card is not None and self.window().state == 'review'
 
 
-    @util.api()
+    @util.api(readOnly=True)
     def guiCurrentCard(self):
         if not self.guiReviewActive():
             raise Exception('Gui review is not currently active.')
@@ -1118,22 +1892,93 @@ class AnkiConnect:
 
 
     @util.api()
-    def addNotes(self, notes):
-        results = []
-        for note in notes:
+    def addNotes(self, notes, errors=False):
+        collection = self.collection()
+        models = {}
+        decks = {}
+        results = [None] * len(notes)
+
+        candidates = []
+        for index, note in enumerate(notes):
             try:
-                results.append(self.addNote(note))
-            except Exception:
-                results.append(None)
+                ankiNote, did = self.buildNote(note, models, decks)
+                candidates.append((index, note, ankiNote, did))
+            except Exception as e:
+                results[index] = e
+
+        # duplicates of notes already in the collection are rejected before any audio is fetched
+        existing = {}
+        for mid in set(ankiNote.mid for index, note, ankiNote, did in candidates):
+            values = [ankiNote.fields[0] for index, note, ankiNote, did in candidates if ankiNote.mid == mid]
+            existing[mid] = self.existingFirstFields(mid, values)
+
+        accepted = []
+        for index, note, ankiNote, did in candidates:
+            firstField = anki.utils.stripHTMLMedia(ankiNote.fields[0])
+            if not firstField.strip():
+                results[index] = Exception('cannot create note because it is empty')
+            elif firstField in existing[ankiNote.mid] and not self.allowDuplicate(note):
+                results[index] = Exception('cannot create note because it is a duplicate')
+            else:
+                accepted.append((index, note, ankiNote, did, firstField))
 
-        return results
+        # audio for the whole batch is fetched in parallel while notes are being added
+        downloads = [self.downloadAudio(note) for index, note, ankiNote, did, firstField in accepted]
 
+        batch = self.batch
+        self.startEditing()
 
-    @util.api()
+        try:
+            self.batch = True
+            for (index, note, ankiNote, did, firstField), download in zip(accepted, downloads):
+                try:
+                    # earlier notes of the same batch only count as duplicates once they have actually been added
+                    if firstField in existing[ankiNote.mid] and not self.allowDuplicate(note):
+                        raise Exception('cannot create note because it is a duplicate')
+
+                    self.attachAudio(ankiNote, note, download)
+                    ankiNote.model()['did'] = did
+                    if collection.addNote(ankiNote) < 1:
+                        raise Exception('The field values you have provided would make an empty question on all cards.')
+                    existing[ankiNote.mid].add(firstField)
+                    results[index] = ankiNote.id
+                except Exception as e:
+                    results[index] = e
+        finally:
+            self.batch = batch
+
+        # the whole import is committed at once unless it is part of an enclosing batch
+        if not self.batch:
+            collection.save()
+        self.stopEditing()
+
+        if errors:
+            return [{'result': None, 'error': str(r)} if isinstance(r, Exception) else {'result': r, 'error': None} for r in results]
+        else:
+            return [None if isinstance(r, Exception) else r for r in results]
+
+
+    @util.api(readOnly=True)
     def canAddNotes(self, notes):
-        results = []
-        for note in notes:
-            results.append(self.canAddNote(note))
+        models = {}
+        decks = {}
+        results = [False] * len(notes)
+
+        # only the first field of each note is needed, so no notes are created to answer this
+        candidates = {}
+        for index, note in enumerate(notes):
+            try:
+                model, deck = self.noteModelAndDeck(note, models, decks)
+                firstField = note['fields'].get(model['flds'][0]['name'], '')
+                candidates.setdefault(model['id'], []).append((index, firstField, self.allowDuplicate(note)))
+            except Exception:
+                pass
+
+        for mid, entries in candidates.items():
+            existing = self.existingFirstFields(mid, [firstField for index, firstField, allowDuplicate in entries])
+            for index, firstField, allowDuplicate in entries:
+                firstField = anki.utils.stripHTMLMedia(firstField)
+                results[index] = bool(firstField.strip()) and (allowDuplicate or firstField not in existing)
 
         return results
 
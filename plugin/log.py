@@ -0,0 +1,171 @@
+# Copyright 2016-2020 Alex Yatskov
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import queue
+import random
+import threading
+import time
+import types
+
+
+#
+# LogWriter
+#
+
+class LogWriter:
+    def __init__(self, path, maxBytes, backupCount, queueSize, maxPayload, sampling):
+        self.path = path
+        self.maxBytes = maxBytes
+        self.backupCount = backupCount
+        self.maxPayload = maxPayload
+        self.sampling = sampling
+        self.queue = queue.Queue(queueSize)
+        self.dropped = 0
+        self.file = open(self.path, 'a', encoding='utf-8')
+        self.thread = threading.Thread(target=self.run, name='AnkiConnectLog', daemon=True)
+        self.thread.start()
+
+
+    def sample(self, action):
+        rate = self.sampling.get(action, self.sampling.get('*', 1.0))
+        return rate >= 1.0 or random.random() < rate
+
+
+    def write(self, name, action, data):
+        # payloads are copied and cut down here, since the caller keeps using them; encoding and file I/O happen on the writer thread
+        try:
+            self.queue.put_nowait((time.time(), name, action, self.truncate(data)))
+        except queue.Full:
+            self.dropped += 1
+
+
+    def close(self):
+        # the main thread never waits long on a writer that is stuck or far behind
+        try:
+            self.queue.put(None, timeout=1.0)
+        except queue.Full:
+            pass
+
+        self.thread.join(1.0)
+
+
+    def run(self):
+        while True:
+            event = self.queue.get()
+            if event is None:
+                break
+
+            # a log file that was moved or deleted is reopened rather than ending the writer thread
+            try:
+                self.writeLine(*event)
+                if self.queue.empty():
+                    self.file.flush()
+            except Exception:
+                self.dropped += 1
+                self.reopen()
+
+        if self.file is not None:
+            self.file.close()
+
+
+    def reopen(self):
+        try:
+            if self.file is not None:
+                self.file.close()
+        except Exception:
+            pass
+
+        try:
+            self.file = open(self.path, 'a', encoding='utf-8')
+        except Exception:
+            self.file = None
+
+
+    def writeLine(self, timestamp, name, action, data):
+        line = {'time': round(timestamp, 3), 'event': name, 'action': action}
+
+        if self.dropped:
+            line['dropped'] = self.dropped
+            self.dropped = 0
+
+        try:
+            payload = json.dumps(data, separators=(',', ':'))
+        except Exception as e:
+            payload = json.dumps('unserializable payload: {}'.format(e))
+
+        if len(payload) > self.maxPayload:
+            line['data'] = payload[:self.maxPayload]
+            line['truncated'] = len(payload)
+        else:
+            line['data'] = json.loads(payload)
+
+        line = json.dumps(line, separators=(',', ':')) + '\n'
+        if self.file.tell() + len(line) > self.maxBytes:
+            self.rotate()
+
+        self.file.write(line)
+
+
+    def truncate(self, data, budget=None):
+        # one character budget is shared by the whole copy, as the line is cut to maxPayload characters anyway
+        if budget is None:
+            budget = [self.maxPayload]
+
+        if isinstance(data, (bool, int, float, type(None))):
+            budget[0] -= 8
+            return data
+        elif isinstance(data, types.GeneratorType):
+            budget[0] -= 8
+            return '<stream>'
+        elif isinstance(data, str):
+            data = data[:max(budget[0], 0)]
+            budget[0] -= len(data) + 2
+            return data
+        elif isinstance(data, dict):
+            items = {}
+            for key, value in data.items():
+                if budget[0] <= 0:
+                    items['<truncated>'] = len(data) - len(items)
+                    break
+                budget[0] -= len(str(key)) + 4
+                items[key] = self.truncate(value, budget)
+            return items
+        elif isinstance(data, (list, tuple)):
+            items = []
+            for value in data:
+                if budget[0] <= 0:
+                    items.append('<{} more>'.format(len(data) - len(items)))
+                    break
+                budget[0] -= 2
+                items.append(self.truncate(value, budget))
+            return items
+        else:
+            return '<{}>'.format(type(data).__name__)
+
+
+    def rotate(self):
+        self.file.close()
+
+        if self.backupCount > 0:
+            for index in range(self.backupCount - 1, 0, -1):
+                source = '{}.{}'.format(self.path, index)
+                if os.path.exists(source):
+                    os.replace(source, '{}.{}'.format(self.path, index + 1))
+            os.replace(self.path, '{}.1'.format(self.path))
+            self.file = open(self.path, 'a', encoding='utf-8')
+        else:
+            self.file = open(self.path, 'w', encoding='utf-8')
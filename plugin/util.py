@@ -13,11 +13,15 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
+import concurrent.futures
+import hashlib
 import os
+import threading
 
 import anki
 import anki.sync
 import aqt
+import requests.adapters
 from anki.consts import *
 
 
@@ -25,48 +29,186 @@ from anki.consts import *
 # Utilities
 #
 
-def download(url):
-    client = anki.sync.AnkiRequestsClient()
-    client.timeout = setting('webTimeout') / 1000
+downloadState = {'client': None, 'pool': None, 'pending': {}, 'size': 0, 'limit': None}
+downloadLock = threading.RLock()
+
+def download(url, skipHash=None):
+    return downloadAsync(url, skipHash).result()
+
+
+def downloadAsync(url, skipHash=None):
+    # one pooled client and thread pool are shared by every download, and concurrent requests for the same file are merged
+    key = hashlib.sha1('{}\n{}'.format(url, skipHash or '').encode('utf-8')).hexdigest()
+    path = os.path.join(downloadCacheDir(), key)
+
+    with downloadLock:
+        future = downloadState['pending'].get(key)
+        if future is None:
+            if downloadState['pool'] is None:
+                workers = setting('webDownloadWorkers')
+                client = anki.sync.AnkiRequestsClient()
+                client.timeout = setting('webTimeout') / 1000
+                adapter = requests.adapters.HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+                client.session.mount('http://', adapter)
+                client.session.mount('https://', adapter)
+                downloadState['client'] = client
+                downloadState['pool'] = concurrent.futures.ThreadPoolExecutor(workers, 'AnkiConnectDownload')
+
+            # the limit is read here, on the main thread, for the workers to enforce as they write
+            downloadState['limit'] = setting('webDownloadCacheSize')
+            future = downloadState['pool'].submit(downloadFile, downloadState['client'], url, path)
+            downloadState['pending'][key] = future
+            future.add_done_callback(lambda _: downloadDone(key))
+
+    return future
+
+
+def downloadDone(key):
+    with downloadLock:
+        downloadState['pending'].pop(key, None)
+
+
+def downloadFile(client, url, path):
+    if os.path.exists(path):
+        with open(path, 'rb') as file:
+            return file.read()
+
     resp = client.get(url)
     if resp.status_code == 200:
-        return client.streamContent(resp)
+        data = client.streamContent(resp)
     else:
         raise Exception('{} download failed with return code {}'.format(url, resp.status_code))
 
+    partPath = '{}.{}.part'.format(path, threading.get_ident())
+    with open(partPath, 'wb') as file:
+        file.write(data)
+    os.replace(partPath, path)
+
+    with downloadLock:
+        downloadState['size'] += len(data)
+        limit = downloadState['limit']
+        full = limit is not None and downloadState['size'] > limit
+
+    if full:
+        pruneDownloadCache(limit)
+
+    return data
+
+
+def downloadCacheDir():
+    path = os.path.join(os.path.dirname(__file__), 'user_files', 'downloads')
+    os.makedirs(path, exist_ok=True)
+    return path
 
-def api(*versions):
+
+def pruneDownloadCache(limit=None):
+    if limit is None:
+        limit = setting('webDownloadCacheSize')
+
+    entries = []
+    with os.scandir(downloadCacheDir()) as it:
+        for entry in it:
+            # files still being written, or already removed by a concurrent prune, are left alone
+            try:
+                if entry.is_file():
+                    stat = entry.stat()
+                    if not entry.name.endswith('.part') or time.time() - stat.st_mtime > 3600:
+                        entries.append((stat.st_mtime, stat.st_size, entry.path))
+            except OSError:
+                pass
+
+    # oldest entries go first once the cache outgrows its limit
+    size = sum(entry[1] for entry in entries)
+    for mtime, length, path in sorted(entries):
+        if size <= limit:
+            break
+        try:
+            os.remove(path)
+            size -= length
+        except OSError:
+            pass
+
+    with downloadLock:
+        downloadState['size'] = size
+
+
+def api(*versions, cached=False, readOnly=False):
     def decorator(func):
         method = lambda *args, **kwargs: func(*args, **kwargs)
         setattr(method, 'versions', versions)
         setattr(method, 'api', True)
+        setattr(method, 'cached', cached)
+        setattr(method, 'readOnly', readOnly or cached)
         return method
 
     return decorator
 
 
-def setting(key):
+def loadSettings():
     defaults = {
-        'apiKey':          None,
-        'apiLogPath':      None,
-        'apiPollInterval': 25,
-        'apiVersion':      6,
-        'webBacklog':      5,
-        'webBindAddress':  os.getenv('ANKICONNECT_BIND_ADDRESS', '127.0.0.1'),
-        'webBindPort':     8765,
-        'webCorsOrigin':   os.getenv('ANKICONNECT_CORS_ORIGIN', 'http://localhost'),
-        'webTimeout':      10000,
+        'apiCacheMaxItems':        100000,
+        'apiCacheSize':            64,
+        'apiKey':                  None,
+        'apiLogBackupCount':       3,
+        'apiLogMaxBytes':          10485760,
+        'apiLogMaxPayload':        4096,
+        'apiLogPath':              None,
+        'apiLogQueueSize':         1000,
+        'apiLogSampling':          {},
+        'apiPollInterval':         25,
+        'apiQueryLimit':           32,
+        'apiQueryTTL':             300000,
+        'apiVersion':              6,
+        'webAcceptLimit':          64,
+        'webBacklog':              5,
+        'webBindAddress':          os.getenv('ANKICONNECT_BIND_ADDRESS', '127.0.0.1'),
+        'webBindPort':             8765,
+        'webCompressionLevel':     6,
+        'webCompressionMinSize':   1024,
+        'webCorsOrigin':           os.getenv('ANKICONNECT_CORS_ORIGIN', 'http://localhost'),
+        'webDownloadCacheSize':    104857600,
+        'webDownloadWorkers':      8,
+        'webKeepAliveMaxRequests': 100,
+        'webKeepAliveTimeout':     5000,
+        'webRequestMaxSize':       268435456,
+        'webTimeout':              10000,
     }
 
     config = aqt.mw.addonManager.getConfig(__name__)
     if 'profiles' in config and aqt.mw.pm.name in config['profiles']:
         config.update(config['profiles'][aqt.mw.pm.name])
 
+    settings = {}
+    for key, default in defaults.items():
+        value = config.get(key, default)
+        # values edited by hand in the config dialog are coerced to the type of their default
+        if value is not None and default is not None and type(value) is not type(default):
+            try:
+                value = type(default)(value)
+            except (TypeError, ValueError):
+                raise Exception('setting {} must be of type {}'.format(key, type(default).__name__))
+        settings[key] = value
+
+    return settings
+
+
+settingsCache = {}
+
+def setting(key):
+    profile = aqt.mw.pm.name
+    if profile not in settingsCache:
+        settingsCache.clear()
+        settingsCache[profile] = loadSettings()
+
     try:
-        return config.get(key, defaults[key])
-    except:
+        return settingsCache[profile][key]
+    except KeyError:
         raise Exception('setting {} not found'.format(key))
 
+
+def invalidateSettings(config=None):
+    settingsCache.clear()
+
 import time
 from anki.rsbackend import TR
 from aqt.utils import tr
@@ -13,9 +13,17 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
+import collections
+import errno
+import itertools
 import json
-import select
+import os
+import selectors
 import socket
+import tempfile
+import time
+import types
+import zlib
 
 from . import web, util
 
@@ -25,9 +33,76 @@ from . import web, util
 #
 
 class WebRequest:
-    def __init__(self, headers, body):
+    def __init__(self, method, path, version, headers, body):
+        self.method = method
+        self.path = path
+        self.version = version
         self.headers = headers
         self.body = body
+        self.keepAlive = False
+        self.route = None
+
+
+    def wantsKeepAlive(self):
+        connection = (self.headers.get('connection'.encode('utf-8')) or bytes()).lower()
+        if self.version == 'HTTP/1.1'.encode('utf-8'):
+            return connection != 'close'.encode('utf-8')
+        else:
+            return connection == 'keep-alive'.encode('utf-8')
+
+
+#
+# WebUpload
+#
+
+class WebUpload:
+    def __init__(self, directory):
+        fd, self.path = tempfile.mkstemp(prefix='.upload-', dir=directory)
+        self.file = os.fdopen(fd, 'wb')
+        self.size = 0
+
+
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+
+
+    def commit(self, path):
+        # the finished file replaces its target in one step, so readers never see a partial upload
+        self.file.close()
+        os.replace(self.path, path)
+        self.path = None
+
+
+    def close(self):
+        self.file.close()
+        if self.path is not None:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+            self.path = None
+
+
+#
+# WebFile
+#
+
+class WebFile:
+    def __init__(self, file, offset, length):
+        self.file = file
+        self.offset = offset
+        self.length = length
+        self.remaining = length
+        self.sendfile = hasattr(os, 'sendfile')
+
+
+    def __len__(self):
+        return self.length
+
+
+    def close(self):
+        self.file.close()
 
 
 #
@@ -35,70 +110,308 @@ class WebRequest:
 #
 
 class WebClient:
-    def __init__(self, sock, handler):
+    def __init__(self, sock, handler, selector, maxRequests, opener=None, bodySizeMax=1 << 28, recvSizeMax=1 << 20):
         self.sock = sock
         self.handler = handler
-        self.readBuff = bytes()
-        self.writeBuff = bytes()
-
-
-    def advance(self, recvSize=1024):
+        self.opener = opener
+        self.selector = selector
+        self.maxRequests = maxRequests
+        self.bodySizeMax = bodySizeMax
+        self.requests = 0
+        self.closing = False
+        self.lastActivity = time.monotonic()
+        self.events = selectors.EVENT_READ
+        self.recvSize = 4096
+        self.recvSizeMax = recvSizeMax
+        self.readBuff = bytearray()
+        self.writeQueue = collections.deque()
+        self.headerScan = 0
+        self.request = None
+        self.bodyView = None
+        self.bodyFilled = 0
+        self.bodyLength = 0
+        self.bodySink = None
+        self.bodyRemaining = 0
+        self.selector.register(self.sock, self.events, self)
+
+
+    def advance(self, mask):
         if self.sock is None:
             return False
 
-        rlist, wlist = select.select([self.sock], [self.sock], [], 0)[:2]
+        try:
+            if mask & selectors.EVENT_READ:
+                if not self.receive():
+                    self.close()
+                    return False
+
+                self.lastActivity = time.monotonic()
+
+                # answer every complete request already buffered, in the order they were pipelined
+                while not self.closing and self.parseRequest():
+                    req = self.request
+                    self.request = None
+                    self.requests += 1
+                    req.keepAlive = req.wantsKeepAlive() and self.requests < self.maxRequests
+                    self.closing = not req.keepAlive
+                    for buff in self.handler(req):
+                        if isinstance(buff, (types.GeneratorType, WebFile)):
+                            self.writeQueue.append(buff)
+                        elif buff:
+                            self.writeQueue.append(memoryview(buff))
+
+            # the socket is almost always writable right after a request has been handled,
+            # so try to flush immediately instead of waiting for the next readiness event
+            if self.writeQueue:
+                self.send()
+                self.lastActivity = time.monotonic()
+                if not self.writeQueue and self.closing:
+                    self.close()
+                    return False
+        except BlockingIOError:
+            pass
+        except (OSError, ValueError, MemoryError):
+            self.close()
+            return False
+
+        self.updateEvents()
+        return True
 
-        if rlist:
-            msg = self.sock.recv(recvSize)
-            if not msg:
-                self.close()
-                return False
 
+    def receive(self):
+        # request bodies are read straight into their preallocated buffer
+        if self.bodyView is not None and not self.readBuff:
+            length = self.sock.recv_into(self.bodyView[self.bodyFilled:])
+            self.bodyFilled += length
+            self.growBody()
+            return length > 0
+
+        # streamed bodies pass through in fixed-size pieces and are never held in memory as a whole
+        if self.bodySink is not None and not self.readBuff:
+            msg = self.sock.recv(min(self.recvSizeMax, self.bodyRemaining))
+            self.bodySink.write(msg)
+            self.bodyRemaining -= len(msg)
+            return len(msg) > 0
+
+        msg = self.sock.recv(self.recvSize)
+        if len(msg) == self.recvSize:
+            self.recvSize = min(self.recvSize * 2, self.recvSizeMax)
+
+        # whatever arrives after a rejected request is dropped until the rejection has been sent
+        if not self.closing:
             self.readBuff += msg
 
-            req, length = self.parseRequest(self.readBuff)
-            if req is not None:
-                self.readBuff = self.readBuff[length:]
-                self.writeBuff += self.handler(req)
+        return len(msg) > 0
 
-        if wlist and self.writeBuff:
-            length = self.sock.send(self.writeBuff)
-            self.writeBuff = self.writeBuff[length:]
-            if not self.writeBuff:
-                self.close()
-                return False
 
-        return True
+    def growBody(self, stepSize=1 << 22):
+        # the buffer follows the data actually received rather than the length a client announced
+        body = self.request.body
+        if self.bodyFilled == len(body) < self.bodyLength:
+            self.bodyView.release()
+            body.extend(bytes(min(max(len(body), stepSize), self.bodyLength - len(body))))
+            self.bodyView = memoryview(body)
+
+
+    def send(self, iovMax=64):
+        while self.writeQueue:
+            if isinstance(self.writeQueue[0], WebFile):
+                self.sendFile()
+                continue
+            elif not isinstance(self.writeQueue[0], memoryview):
+                self.produce()
+                continue
+
+            buffs = list(itertools.takewhile(lambda buff: isinstance(buff, memoryview), itertools.islice(self.writeQueue, iovMax)))
+            if hasattr(self.sock, 'sendmsg'):
+                length = self.sock.sendmsg(buffs)
+            else:
+                length = self.sock.send(buffs[0])
+
+            # advance through the queue by slicing views, so pending data is never copied
+            pending = length
+            while pending > 0:
+                buff = self.writeQueue[0]
+                if pending >= len(buff):
+                    self.writeQueue.popleft()
+                    pending -= len(buff)
+                else:
+                    self.writeQueue[0] = buff[pending:]
+                    pending = 0
+
+            if length < sum(len(buff) for buff in buffs):
+                break
+
+
+    def sendFile(self, chunkSize=1 << 20):
+        item = self.writeQueue[0]
+        if item.remaining == 0:
+            item.close()
+            self.writeQueue.popleft()
+            return
+
+        # file contents go from the page cache to the socket without passing through python where the platform allows it
+        length = None
+        if item.sendfile:
+            try:
+                length = os.sendfile(self.sock.fileno(), item.file.fileno(), item.offset, min(item.remaining, chunkSize))
+            except OSError as e:
+                if e.errno not in (errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK, errno.EOPNOTSUPP):
+                    raise
+                item.sendfile = False
+
+        if length is None:
+            item.file.seek(item.offset)
+            data = item.file.read(min(item.remaining, chunkSize))
+            length = self.sock.send(data) if data else 0
+
+        # a file that shrank after its length was announced can no longer be sent in full
+        if length == 0:
+            raise ConnectionAbortedError()
+
+        item.offset += length
+        item.remaining -= length
+
+
+    def produce(self):
+        # streamed bodies are only pulled from once everything queued ahead of them has been sent
+        producer = self.writeQueue[0]
+        try:
+            chunk = next(producer, None)
+        except Exception:
+            # the status line is already out, so aborting the connection is the only way left to report failure
+            raise ConnectionAbortedError()
+
+        if chunk is None:
+            self.writeQueue.popleft()
+        elif chunk:
+            self.writeQueue.appendleft(memoryview(chunk))
+
+
+    def updateEvents(self):
+        events = selectors.EVENT_READ
+        if self.writeQueue:
+            events |= selectors.EVENT_WRITE
+
+        if events != self.events:
+            self.selector.modify(self.sock, events, self)
+            self.events = events
 
 
     def close(self):
         if self.sock is not None:
+            self.selector.unregister(self.sock)
             self.sock.close()
             self.sock = None
 
-        self.readBuff = bytes()
-        self.writeBuff = bytes()
+        if self.bodySink is not None:
+            self.bodySink.close()
+            self.bodySink = None
+
+        for item in self.writeQueue:
+            if isinstance(item, WebFile):
+                item.close()
+
+        self.readBuff = bytearray()
+        self.writeQueue.clear()
+        self.request = None
+        self.bodyView = None
+
+
+    def parseRequest(self):
+        if self.request is None and not self.parseHeaders():
+            return False
+
+        if self.bodyView is not None:
+            while self.readBuff and self.bodyFilled < self.bodyLength:
+                length = min(len(self.readBuff), len(self.bodyView) - self.bodyFilled)
+                self.bodyView[self.bodyFilled : self.bodyFilled + length] = self.readBuff[:length]
+                self.bodyFilled += length
+                del self.readBuff[:length]
+                self.growBody()
+
+            if self.bodyFilled < self.bodyLength:
+                return False
+
+            self.bodyView.release()
+            self.bodyView = None
+
+        if self.bodySink is not None:
+            if self.readBuff:
+                length = min(len(self.readBuff), self.bodyRemaining)
+                self.bodySink.write(self.readBuff[:length])
+                self.bodyRemaining -= length
+                del self.readBuff[:length]
+
+            if self.bodyRemaining > 0:
+                return False
+
+            self.bodySink = None
+
+        return True
+
+
+    def reject(self, status):
+        self.writeQueue.append(memoryview('HTTP/1.1 {}\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'.format(status).encode('utf-8')))
+        self.closing = True
+        self.request = None
+        self.readBuff = bytearray()
+        self.headerScan = 0
+
+
+    def parseHeaders(self, headerSizeMax=1 << 16):
+        # only scan the bytes received since the last attempt, allowing for a terminator split across reads
+        headerEnd = self.readBuff.find('\r\n\r\n'.encode('utf-8'), max(self.headerScan - 3, 0))
+        if headerEnd > headerSizeMax or (headerEnd == -1 and len(self.readBuff) > headerSizeMax):
+            self.reject('431 Request Header Fields Too Large')
+            return False
+        elif headerEnd == -1:
+            self.headerScan = len(self.readBuff)
+            return False
 
+        lines = bytes(self.readBuff[:headerEnd]).split('\r\n'.encode('utf-8'))
+        del self.readBuff[:headerEnd + 4]
+        self.headerScan = 0
 
-    def parseRequest(self, data):
-        parts = data.split('\r\n\r\n'.encode('utf-8'), 1)
-        if len(parts) == 1:
-            return None, 0
+        requestLine = lines[0].split(' '.encode('utf-8'))
+        if len(requestLine) == 3:
+            method, path, version = requestLine
+        else:
+            method, path, version = bytes(), bytes(), 'HTTP/1.0'.encode('utf-8')
 
         headers = {}
-        for line in parts[0].split('\r\n'.encode('utf-8')):
+        for line in lines[1:]:
             pair = line.split(': '.encode('utf-8'))
             headers[pair[0].lower()] = pair[1] if len(pair) > 1 else None
 
-        headerLength = len(parts[0]) + 4
-        bodyLength = int(headers.get('content-length'.encode('utf-8'), 0))
-        totalLength = headerLength + bodyLength
+        try:
+            length = int(headers.get('content-length'.encode('utf-8'), 0))
+        except ValueError:
+            length = -1
+
+        if length < 0:
+            self.reject('400 Bad Request')
+            return False
 
-        if totalLength > len(data):
-            return None, 0
+        self.request = WebRequest(method, path, version, headers, None)
+        self.bodyFilled = 0
+        self.bodyLength = length
+        self.bodyRemaining = length
 
-        body = data[headerLength : totalLength]
-        return WebRequest(headers, body), totalLength
+        sink = self.opener(self.request) if self.opener is not None else None
+        if sink is None and length > self.bodySizeMax:
+            self.reject('413 Payload Too Large')
+            return False
+        elif sink is None:
+            self.request.body = bytearray(min(length, 1 << 16))
+            if length:
+                self.bodyView = memoryview(self.request.body)
+        else:
+            self.request.body = sink
+            if length:
+                self.bodySink = sink
+
+        return True
 
 
 #
@@ -108,79 +421,263 @@ class WebClient:
 class WebServer:
     def __init__(self, handler):
         self.handler = handler
-        self.clients = []
+        self.routes = []
+        self.clients = set()
         self.sock = None
+        self.selector = None
+        self.acceptLimit = 1
+        self.keepAliveTimeout = 0
+        self.keepAliveMaxRequests = 1
+        self.bodySizeMax = 0
+        self.compressionLevel = 0
+        self.compressionMinSize = 0
+        self.lastSweep = time.monotonic()
 
 
     def advance(self):
-        if self.sock is not None:
-            self.acceptClients()
-            self.advanceClients()
+        if self.sock is None:
+            return
+
+        for key, mask in self.selector.select(0):
+            if key.data is None:
+                self.acceptClients()
+            elif not key.data.advance(mask):
+                self.clients.discard(key.data)
+
+        now = time.monotonic()
+        if now - self.lastSweep >= 1:
+            self.lastSweep = now
+            self.closeIdleClients(now)
+
+
+    def closeIdleClients(self, now):
+        for client in list(self.clients):
+            if now - client.lastActivity > self.keepAliveTimeout:
+                client.close()
+                self.clients.discard(client)
+
+
+    def fileno(self):
+        # selectors backed by a kernel object (epoll, kqueue) are themselves readable whenever a registered socket is ready
+        if self.selector is not None and hasattr(self.selector, 'fileno'):
+            return self.selector.fileno()
+        else:
+            return None
 
 
     def acceptClients(self):
-        rlist = select.select([self.sock], [], [], 0)[0]
-        if not rlist:
-            return
+        for _ in range(self.acceptLimit):
+            try:
+                clientSock = self.sock.accept()[0]
+            except BlockingIOError:
+                break
 
-        clientSock = self.sock.accept()[0]
-        if clientSock is not None:
             clientSock.setblocking(False)
-            self.clients.append(WebClient(clientSock, self.handlerWrapper))
+            self.clients.add(WebClient(clientSock, self.handlerWrapper, self.selector, self.keepAliveMaxRequests, self.openBody, self.bodySizeMax))
+
+
+    def route(self, prefix, handler, opener=None):
+        # requests under a route bypass the JSON api; the opener may return a sink that receives the body as it arrives
+        self.routes.append((prefix.encode('utf-8'), handler, opener))
 
 
-    def advanceClients(self):
-        self.clients = list(filter(lambda c: c.advance(), self.clients))
+    def openBody(self, req):
+        for route in self.routes:
+            if req.path.startswith(route[0]):
+                req.route = route
+                if route[2] is not None:
+                    return route[2](req)
+                break
+
+        return None
 
 
     def listen(self):
         self.close()
 
+        self.selector = selectors.DefaultSelector()
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.sock.setblocking(False)
         self.port = util.setting('webBindPort')
         self.sock.bind((util.setting('webBindAddress'), self.port))
-        self.sock.listen(util.setting('webBacklog'))
+
+        # the backlog has to hold at least one tick worth of connections for bursts to be absorbed
+        self.acceptLimit = max(util.setting('webAcceptLimit'), 1)
+        self.sock.listen(max(util.setting('webBacklog'), self.acceptLimit))
+
+        self.keepAliveTimeout = util.setting('webKeepAliveTimeout') / 1000
+        self.keepAliveMaxRequests = max(util.setting('webKeepAliveMaxRequests'), 1)
+        self.bodySizeMax = util.setting('webRequestMaxSize')
+        self.compressionLevel = util.setting('webCompressionLevel')
+        self.compressionMinSize = util.setting('webCompressionMinSize')
+        self.selector.register(self.sock, selectors.EVENT_READ, None)
 
 
     def handlerWrapper(self, req):
-        if len(req.body) == 0:
-            body = 'AnkiConnect v.{}'.format(util.setting('apiVersion')).encode('utf-8')
+        if req.route is not None:
+            status, headers, body = req.route[1](req)
         else:
+            status, headers, body = self.handleApi(req)
+
+        chunked = isinstance(body, types.GeneratorType) and not any(key == 'Content-Length' for key, value in headers)
+        if chunked and req.version != 'HTTP/1.1'.encode('utf-8'):
             try:
-                params = json.loads(req.body.decode('utf-8'))
-                body = json.dumps(self.handler(params)).encode('utf-8')
-            except ValueError:
-                body = json.dumps(None).encode('utf-8')
+                body = bytes().join(body)
+            except Exception:
+                raise ConnectionAbortedError()
+            chunked = False
+
+        if chunked:
+            body = self.encodeChunks(body)
 
         headers = [
-            ['HTTP/1.1 200 OK', None],
-            ['Content-Type', 'text/json'],
+            ['HTTP/1.1 {}'.format(status), None],
             ['Access-Control-Allow-Origin', util.setting('webCorsOrigin')],
-            ['Content-Length', str(len(body))]
-        ]
+            ['Connection', 'keep-alive' if req.keepAlive else 'close']
+        ] + headers
+
+        if chunked:
+            headers.append(['Transfer-Encoding', 'chunked'])
+        elif not isinstance(body, types.GeneratorType) and not status.startswith('304'):
+            headers.append(['Content-Length', str(len(body))])
 
-        resp = bytes()
+        if req.keepAlive:
+            headers.append(['Keep-Alive', 'timeout={}'.format(int(self.keepAliveTimeout))])
 
+        lines = []
         for key, value in headers:
             if value is None:
-                resp += '{}\r\n'.format(key).encode('utf-8')
+                lines.append(key)
             else:
-                resp += '{}: {}\r\n'.format(key, value).encode('utf-8')
+                lines.append('{}: {}'.format(key, value))
+
+        lines.extend(['', ''])
+
+        # header and body are handed over as separate buffers and written with a single vectored send
+        return ['\r\n'.join(lines).encode('utf-8'), body]
 
-        resp += '\r\n'.encode('utf-8')
-        resp += body
 
-        return resp
+    def handleApi(self, req):
+        stream = False
+
+        if len(req.body) == 0:
+            body = 'AnkiConnect v.{}'.format(util.setting('apiVersion')).encode('utf-8')
+        else:
+            try:
+                params = json.loads(req.body.decode('utf-8'))
+                reply = self.handler(params)
+                if self.isStream(reply):
+                    body = self.encodeStream(reply)
+                    stream = True
+                else:
+                    body = json.dumps(reply).encode('utf-8')
+            except ValueError:
+                body = json.dumps(None).encode('utf-8')
+
+        headers = [['Content-Type', 'text/json']]
+
+        # streamed bodies are of unknown size, so they are always worth compressing
+        encoding = self.acceptedEncoding(req)
+        if encoding is not None and (stream or len(body) >= self.compressionMinSize):
+            body = self.compress(body, encoding, stream)
+            headers.append(['Content-Encoding', encoding])
+            headers.append(['Vary', 'Accept-Encoding'])
+
+        return '200 OK', headers, body
+
+
+    def acceptedEncoding(self, req):
+        if self.compressionLevel <= 0:
+            return None
+
+        accepted = {}
+        for item in (req.headers.get('accept-encoding'.encode('utf-8')) or bytes()).decode('latin-1').split(','):
+            params = item.strip().lower().split(';')
+            quality = 1.0
+            for param in params[1:]:
+                name, _, value = param.strip().partition('=')
+                if name == 'q':
+                    try:
+                        quality = float(value)
+                    except ValueError:
+                        quality = 0.0
+            accepted[params[0]] = quality
+
+        for encoding in ['gzip', 'deflate']:
+            if accepted.get(encoding, accepted.get('*', 0.0)) > 0:
+                return encoding
+
+        return None
+
+
+    def compress(self, body, encoding, stream=False):
+        # gzip framing for gzip, zlib framing for what HTTP calls deflate
+        compressor = zlib.compressobj(self.compressionLevel, zlib.DEFLATED, 31 if encoding == 'gzip' else 15)
+        if stream:
+            return self.compressStream(body, compressor)
+        else:
+            return compressor.compress(body) + compressor.flush()
+
+
+    def compressStream(self, parts, compressor):
+        for part in parts:
+            data = compressor.compress(part)
+            if data:
+                yield data
+
+        yield compressor.flush()
+
+
+    def isStream(self, reply):
+        if isinstance(reply, dict):
+            return any(isinstance(value, types.GeneratorType) for value in reply.values())
+        else:
+            return isinstance(reply, types.GeneratorType)
+
+
+    def encodeStream(self, reply, batchSize=128):
+        if isinstance(reply, dict):
+            for index, (key, value) in enumerate(reply.items()):
+                yield '{}{}: '.format('{' if index == 0 else ', ', json.dumps(key)).encode('utf-8')
+                yield from self.encodeStream(value, batchSize)
+            yield '}'.encode('utf-8')
+        elif isinstance(reply, types.GeneratorType):
+            # items are serialized a batch at a time so that encoding still happens in C
+            yield '['.encode('utf-8')
+            separator = ''
+            while True:
+                batch = list(itertools.islice(reply, batchSize))
+                if not batch:
+                    break
+                yield (separator + json.dumps(batch)[1:-1]).encode('utf-8')
+                separator = ', '
+            yield ']'.encode('utf-8')
+        else:
+            yield json.dumps(reply).encode('utf-8')
+
+
+    def encodeChunks(self, parts):
+        for part in parts:
+            if part:
+                yield '{:x}\r\n'.format(len(part)).encode('utf-8')
+                yield part
+                yield '\r\n'.encode('utf-8')
+
+        yield '0\r\n\r\n'.encode('utf-8')
 
 
     def close(self):
+        for client in self.clients:
+            client.close()
+
+        self.clients = set()
+
         if self.sock is not None:
+            self.selector.unregister(self.sock)
             self.sock.close()
             self.sock = None
 
-        for client in self.clients:
-            client.close()
-
-        self.clients = []
+        if self.selector is not None:
+            self.selector.close()
+            self.selector = None
@@ -20,6 +20,21 @@ class TestCards(unittest.TestCase):
         cardIds = util.invoke('findCards', query='deck:test')
         self.assertEqual(len(cardIds), 1)
 
+        # openQuery
+        query = util.invoke('openQuery', query='deck:test')
+        self.assertEqual(query['total'], len(cardIds))
+
+        # fetchQuery
+        page = util.invoke('fetchQuery', cursor=query['cursor'], limit=1)
+        self.assertEqual(page['ids'], cardIds)
+        self.assertEqual(page['remaining'], 0)
+
+        # closeQuery
+        self.assertFalse(util.invoke('closeQuery', cursor=query['cursor']))
+        query = util.invoke('openQuery', query='deck:test', type='notes')
+        self.assertEqual(query['total'], 1)
+        self.assertTrue(util.invoke('closeQuery', cursor=query['cursor']))
+
         # suspend
         util.invoke('suspend', cards=cardIds)
 
@@ -55,6 +70,10 @@ class TestCards(unittest.TestCase):
         self.assertEqual(len(cardsInfo), len(cardIds))
         for i, cardInfo in enumerate(cardsInfo):
             self.assertEqual(cardInfo['cardId'], cardIds[i])
+        self.assertRaises(Exception, lambda: util.invoke('cardsInfo', cards=1))
+        results = util.invoke('multi', actions=[util.request('cardsInfo', cards=1), util.request('cardsInfo', cards=cardIds)])
+        self.assertIsNotNone(results[0]['error'])
+        self.assertEqual(len(results[1]['result']), len(cardIds))
 
 
 if __name__ == '__main__':
@@ -1,5 +1,7 @@
 #!/usr/bin/env python
 
+import base64
+import hashlib
 import unittest
 import util
 
@@ -23,6 +25,30 @@ class TestMedia(unittest.TestCase):
         media = util.invoke('retrieveMediaFile', filename=filename)
         self.assertFalse(media)
 
+        # storeMediaFiles
+        digest = hashlib.sha1(base64.b64decode(data)).hexdigest()
+        results = util.invoke('storeMediaFiles', files=[{'filename': filename, 'hash': digest}])
+        self.assertEqual(results[0]['status'], 'missing')
+        results = util.invoke('storeMediaFiles', files=[{'filename': filename, 'data': data}])
+        self.assertEqual(results[0]['status'], 'stored')
+        results = util.invoke('storeMediaFiles', files=[{'filename': filename, 'hash': digest}])
+        self.assertEqual(results[0]['status'], 'unchanged')
+
+        # retrieveMediaFiles
+        results = util.invoke('retrieveMediaFiles', files=[{'filename': filename, 'hash': digest}, {'filename': filename}])
+        self.assertEqual(results[0]['status'], 'unchanged')
+        self.assertEqual(results[1]['status'], 'retrieved')
+        self.assertEqual(results[1]['data'], data)
+
+        # mediaManifest
+        manifest = util.invoke('mediaManifest')
+        self.assertTrue(manifest['full'])
+        self.assertIn({'filename': filename, 'hash': digest}, [{'filename': file['filename'], 'hash': file['hash']} for file in manifest['files']])
+        util.invoke('deleteMediaFile', filename=filename)
+        manifest = util.invoke('mediaManifest', since=manifest['token'])
+        self.assertFalse(manifest['full'])
+        self.assertIn(filename, manifest['deleted'])
+
 
 if __name__ == '__main__':
     unittest.main()
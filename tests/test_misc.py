@@ -9,6 +9,23 @@ class TestMisc(unittest.TestCase):
         # version
         self.assertEqual(util.invoke('version'), 6)
 
+        # apiReflect
+        result = util.invoke('apiReflect', scopes=['actions'], actions=['apiReflect', 'version', 'invalidAction'])
+        self.assertEqual(result['scopes'], ['actions'])
+        self.assertEqual(result['actions'], ['apiReflect', 'version'])
+
+        # cacheStats
+        util.invoke('cacheStats', reset=True)
+        util.invoke('deckNames')
+        util.invoke('deckNames')
+        stats = util.invoke('cacheStats')
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        util.invoke('createDeck', deck='test')
+        self.assertIn('test', util.invoke('deckNames'))
+        util.invoke('deleteDecks', decks=['test'], cardsToo=True)
+        self.assertNotIn('test', util.invoke('deckNames'))
+
         # sync
         util.invoke('sync')
 
@@ -20,6 +37,14 @@ class TestMisc(unittest.TestCase):
             self.assertIsNone(result['error'])
             self.assertEqual(result['result'], 6)
 
+        # multi (transactional)
+        actions = [util.request('createDeck', deck='test'), util.request('invalidAction')]
+        results = util.invoke('multi', actions=actions, rollback=True)
+        self.assertEqual(len(results), len(actions))
+        for result in results:
+            self.assertIsNotNone(result['error'])
+        self.assertNotIn('test', util.invoke('deckNames'))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,7 +1,10 @@
 #!/usr/bin/env python
 
+import http.server
+import threading
 import unittest
 import util
+import uuid
 
 
 class TestNotes(unittest.TestCase):
@@ -53,6 +56,15 @@ class TestNotes(unittest.TestCase):
         self.assertEqual(noteInfo['fields']['Front']['value'], 'front2')
         self.assertEqual(noteInfo['fields']['Back']['value'], 'back2')
 
+        # updateNotesFields
+        noteUpdates = [{'id': noteId, 'fields': {'Back': 'back3'}}, {'id': noteId, 'fields': {'Back': 'back3'}}, {'id': 0, 'fields': {}}]
+        results = util.invoke('updateNotesFields', notes=noteUpdates)
+        self.assertEqual([result['result'] for result in results], ['updated', 'unchanged', None])
+        self.assertIsNotNone(results[2]['error'])
+        noteInfo = util.invoke('notesInfo', notes=[noteId])[0]
+        self.assertEqual(noteInfo['fields']['Front']['value'], 'front2')
+        self.assertEqual(noteInfo['fields']['Back']['value'], 'back3')
+
         notes = [
             {'deckName': 'test', 'modelName': 'Basic', 'fields': {'Front': 'front3', 'Back': 'back3'}, 'tags': ['tag']},
             {'deckName': 'test', 'modelName': 'Basic', 'fields': {'Front': 'front4', 'Back': 'back4'}, 'tags': ['tag']}
@@ -80,6 +92,13 @@ class TestNotes(unittest.TestCase):
         for noteId in noteIds:
             self.assertEqual(noteId, None)
 
+        # addNotes (part 3)
+        noteResults = util.invoke('addNotes', notes=notes, errors=True)
+        self.assertEqual(len(noteResults), len(notes))
+        for noteResult in noteResults:
+            self.assertIsNone(noteResult['result'])
+            self.assertIn('duplicate', noteResult['error'])
+
         # findNotes
         noteIds = util.invoke('findNotes', query='deck:test')
         self.assertEqual(len(noteIds), len(notes) + 1)
@@ -89,5 +108,50 @@ class TestNotes(unittest.TestCase):
         noteIds = util.invoke('findNotes', query='deck:test')
         self.assertEqual(len(noteIds), 0)
 
+class TestNotesAudio(unittest.TestCase):
+    def setUp(self):
+        util.invoke('createDeck', deck='test')
+
+        requests = self.requests = []
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                requests.append(self.path)
+                self.send_response(200)
+                self.send_header('Content-Length', '5')
+                self.end_headers()
+                self.wfile.write('audio'.encode('utf-8'))
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(('localhost', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        util.invoke('deleteDecks', decks=['test'], cardsToo=True)
+
+
+    def runTest(self):
+        url = 'http://localhost:{}/{}.mp3'.format(self.server.server_port, uuid.uuid4().hex)
+        notes = []
+        for i in range(3):
+            audio = {'url': url, 'filename': '_test_audio.mp3', 'fields': ['Back']}
+            fields = {'Front': 'front{}'.format(i), 'Back': 'back{}'.format(i)}
+            notes.append({'deckName': 'test', 'modelName': 'Basic', 'fields': fields, 'tags': [], 'audio': audio})
+
+        # addNotes (audio)
+        noteIds = util.invoke('addNotes', notes=notes)
+        self.assertNotIn(None, noteIds)
+        self.assertEqual(len(self.requests), 1)
+
+        for noteInfo in util.invoke('notesInfo', notes=noteIds):
+            self.assertIn('[sound:_test_audio.mp3]', noteInfo['fields']['Back']['value'])
+
+        util.invoke('deleteMediaFile', filename='_test_audio.mp3')
+
+
 if __name__ == '__main__':
     unittest.main()
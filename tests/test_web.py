@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+import gzip
+import http.client
+import json
+import socket
+import unittest
+import util
+
+
+class TestWeb(unittest.TestCase):
+    def runTest(self):
+        # keep-alive
+        conn = http.client.HTTPConnection('localhost', 8765)
+        for _ in range(3):
+            conn.request('POST', '/', json.dumps(util.request('version')))
+            resp = conn.getresponse()
+            self.assertEqual(resp.getheader('Connection'), 'keep-alive')
+            self.assertEqual(json.loads(resp.read())['result'], 6)
+        conn.close()
+
+        # pipelining
+        body = json.dumps(util.request('version')).encode('utf-8')
+        req = 'POST / HTTP/1.1\r\nContent-Length: {}\r\n\r\n'.format(len(body)).encode('utf-8') + body
+        sock = socket.create_connection(('localhost', 8765))
+        sock.sendall(req * 3 + 'GET / HTTP/1.1\r\nConnection: close\r\n\r\n'.encode('utf-8'))
+        data = bytes()
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+        sock.close()
+        self.assertEqual(data.count('HTTP/1.1 200 OK'.encode('utf-8')), 4)
+        self.assertTrue(data.endswith('AnkiConnect v.6'.encode('utf-8')))
+
+        # chunked
+        conn = http.client.HTTPConnection('localhost', 8765)
+        conn.request('POST', '/', json.dumps(util.request('findCards', query='deck:current')))
+        resp = conn.getresponse()
+        self.assertEqual(resp.getheader('Transfer-Encoding'), 'chunked')
+        self.assertIsInstance(json.loads(resp.read())['result'], list)
+
+        # compression
+        conn.request('POST', '/', json.dumps(util.request('findCards', query='deck:current')), {'Accept-Encoding': 'gzip'})
+        resp = conn.getresponse()
+        self.assertEqual(resp.getheader('Content-Encoding'), 'gzip')
+        self.assertIsInstance(json.loads(gzip.decompress(resp.read()))['result'], list)
+
+        # media
+        conn.request('PUT', '/media/_test%20web.txt', 'test'.encode('utf-8'))
+        resp = conn.getresponse()
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(json.loads(resp.read())['result'], '_test web.txt')
+        conn.request('GET', '/media/_test%20web.txt')
+        resp = conn.getresponse()
+        self.assertEqual(resp.read(), 'test'.encode('utf-8'))
+        conn.request('GET', '/media/_test%20web.txt', headers={'If-None-Match': resp.getheader('ETag')})
+        resp = conn.getresponse()
+        self.assertEqual(resp.status, 304)
+        self.assertEqual(resp.read(), bytes())
+        conn.request('GET', '/media/_test%20web.txt', headers={'Range': 'bytes=1-2'})
+        resp = conn.getresponse()
+        self.assertEqual(resp.status, 206)
+        self.assertEqual(resp.read(), 'es'.encode('utf-8'))
+        conn.request('GET', '/media/_test%20missing.txt')
+        resp = conn.getresponse()
+        self.assertEqual(resp.status, 404)
+        self.assertIsNotNone(json.loads(resp.read())['error'])
+        conn.close()
+        util.invoke('deleteMediaFile', filename='_test web.txt')
+
+
+if __name__ == '__main__':
+    unittest.main()